@@ -0,0 +1,197 @@
+"""Offline benchmarks for the conversion pipeline on synthetic Paprika exports.
+
+    $ python benchmark.py --scales 100,1000,5000 --output bench_results.json
+
+Every scale runs in a fresh process and records wall time, CPU time and peak RSS
+per stage. Results are written as JSON so runs of different commits can be compared;
+the per-recipe columns make super-linear stages stand out.
+"""
+import argparse
+import base64
+import datetime
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+
+import cookbook
+
+DEFAULT_CATEGORIES = [
+    "Grundrezepte", "Frühstück", "Vorspeisen", "Suppen", "Salate",
+    "Hauptgerichte", "Beilagen", "Desserts", "Backen", "Getränke", "Party",
+]
+DEFAULT_IMAGE_SIZES = [(640, 480), (1600, 1200), (4032, 3024)]
+
+# --- SYNTHETIC EXPORTS ---
+
+def make_photo(rng, size):
+    # Distinct content per recipe, so the image cache cannot short-circuit the work
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(8):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.ellipse((x, y, x + size[0] // 4, y + size[1] // 4), fill=tuple(rng.randrange(256) for _ in range(3)))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+def generate_export(path, recipe_count, categories=DEFAULT_CATEGORIES, photo_mode="mixed",
+                    photo_ratio=0.5, image_sizes=DEFAULT_IMAGE_SIZES, seed=0):
+    # photo_mode: "inline" (base64 photo_data), "external" (separate ZIP member
+    # referenced by 'photo'), "mixed" (alternating) or "none"
+    rng = random.Random(seed)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as z:
+        for idx in range(recipe_count):
+            recipe = {
+                "uid": f"BENCH-{seed}-{idx:06d}",
+                "name": f"Recipe {rng.randrange(recipe_count * 10)} {idx}",
+                "categories": rng.sample(categories, rng.choice((1, 1, 2))),
+                "prep_time": f"{rng.randrange(5, 60)} min",
+                "cook_time": f"{rng.randrange(5, 180)} min",
+                "servings": str(rng.randrange(1, 8)),
+                "ingredients": "\n".join(f"{rng.randrange(1, 500)} g ingredient {i}" for i in range(rng.randrange(3, 15))),
+                "directions": "\n".join(f"Step {i}: " + "stir and wait " * rng.randrange(3, 30) for i in range(rng.randrange(2, 10))),
+                "notes": "Synthetic note. " * rng.randrange(0, 5),
+            }
+            mode = photo_mode if photo_mode != "mixed" else ("inline", "external")[idx % 2]
+            if mode != "none" and rng.random() < photo_ratio:
+                photo = make_photo(rng, rng.choice(image_sizes))
+                if mode == "inline":
+                    recipe["photo_data"] = base64.b64encode(photo).decode("ascii")
+                else:
+                    photo_name = f"{recipe['uid']}.jpg"
+                    recipe["photo"] = photo_name
+                    z.writestr(f"photos/{photo_name}", photo)
+            z.writestr(f"{recipe['uid']}.paprikarecipe", gzip.compress(json.dumps(recipe).encode("utf-8")))
+
+# --- MEASUREMENT ---
+
+def measure(fn, *args):
+    # Same numbers process_cookbook reports for its own stages
+    stats = {'stages': {}}
+    with cookbook.timed_stage({}, stats, 'run'):
+        fn(*args)
+    return stats['stages']['run']
+
+# --- BENCHMARK RUNS (each in a fresh process) ---
+
+def run_scale(zip_path, recipe_count, work_dir, skip_render, profile=cookbook.DEFAULT_PROFILE):
+    # Cold image and chapter caches for every run
+    cookbook.IMAGE_CACHE_DIR = os.path.join(work_dir, "image_cache")
+    cookbook.CHAPTER_CACHE_DIR = os.path.join(work_dir, "chapter_cache")
+    results = []
+
+    def add(stage, measured):
+        measured = {key: round(value, 4) for key, value in measured.items()}
+        measured["ms_per_recipe"] = round(measured["seconds"] * 1000 / recipe_count, 4)
+        results.append({"recipes": recipe_count, "stage": stage, **measured})
+
+    # 1. HTML build on its own (no photos, no WeasyPrint)
+    with zipfile.ZipFile(zip_path) as z:
+        members = [f for f in z.namelist() if f.endswith(".paprikarecipe")]
+        photo_index = {os.path.basename(f): f for f in z.namelist()}
+        entries = [entry for _, entry, _ in cookbook.scan_recipes(z, members, photo_index)]
+        entries.sort(key=cookbook.RECIPE_SORT_KEY)
+        cookbook.assign_anchors(entries)
+        html_path = os.path.join(work_dir, "cookbook.html")
+        with open(html_path, "w", encoding="utf-8") as f:
+            add("write_full_html", measure(cookbook.write_full_html, f.write, entries,
+                                           lambda chapter: cookbook.load_recipes(z, chapter), "Benchmark"))
+        del entries
+
+    # 2. One single-document WeasyPrint render of that HTML
+    if not skip_render:
+        add("write_pdf", measure(lambda: cookbook.render_document(filename=html_path).write_pdf(os.path.join(work_dir, "single.pdf"))))
+
+    # 3. The whole job, with the stage stats it records itself
+    job_dir = os.path.join(work_dir, "job")
+    os.makedirs(job_dir)
+    job_zip = os.path.join(job_dir, "upload.zip")
+    shutil.copyfile(zip_path, job_zip)
+    if not skip_render:
+        job = {}
+        cookbook.process_cookbook(job, job_zip, "Benchmark", job_dir, profile)
+        if job.get('status') != 'complete':
+            raise RuntimeError(f"process_cookbook failed: {job.get('error')}")
+        stats = json.loads(job['stats'])
+        for stage, measured in stats['stages'].items():
+            add(f"process_cookbook.{stage}", measured)
+        add("process_cookbook", {
+            "seconds": stats['seconds'],
+            "cpu_seconds": sum(r["cpu_seconds"] for r in stats['stages'].values()),
+            "peak_rss_mb": max(r["peak_rss_mb"] for r in stats['stages'].values()),
+        })
+    return results
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="100,1000,5000", help="comma separated recipe counts")
+    parser.add_argument("--photo-mode", default="mixed", choices=["mixed", "inline", "external", "none"])
+    parser.add_argument("--photo-ratio", type=float, default=0.5, help="share of recipes with a photo")
+    parser.add_argument("--image-sizes", default=",".join(f"{w}x{h}" for w, h in DEFAULT_IMAGE_SIZES),
+                        help="comma separated WxH sizes photos are drawn from")
+    parser.add_argument("--categories", type=int, default=len(DEFAULT_CATEGORIES), help="number of categories to use")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", default=cookbook.DEFAULT_PROFILE, choices=list(cookbook.RENDER_PROFILES),
+                        help="render profile of the whole-job run")
+    parser.add_argument("--skip-render", action="store_true", help="only measure ingestion and HTML build")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(",")]
+    image_sizes = [tuple(int(v) for v in size.split("x")) for size in args.image_sizes.split(",")]
+    categories = (DEFAULT_CATEGORIES * (args.categories // len(DEFAULT_CATEGORIES) + 1))[:args.categories]
+    categories = [f"{cat} {i // len(DEFAULT_CATEGORIES)}" if i >= len(DEFAULT_CATEGORIES) else cat for i, cat in enumerate(categories)]
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": [],
+    }
+    spawn = multiprocessing.get_context("spawn")
+    for recipe_count in scales:
+        work_dir = tempfile.mkdtemp(prefix=f"paprika_bench_{recipe_count}_")
+        try:
+            zip_path = os.path.join(work_dir, "export.paprikarecipes")
+            started = time.perf_counter()
+            generate_export(zip_path, recipe_count, categories, args.photo_mode, args.photo_ratio, image_sizes, args.seed)
+            print(f"{recipe_count} recipes: export generated in {time.perf_counter() - started:.1f}s "
+                  f"({os.path.getsize(zip_path) / 1024 / 1024:.1f} MB)")
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                results = pool.submit(run_scale, zip_path, recipe_count, work_dir, args.skip_render, args.profile).result()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        for r in results:
+            print(f"  {r['stage']:<32} wall {r['seconds']:9.3f}s  cpu {r['cpu_seconds']:9.3f}s  "
+                  f"rss {r['peak_rss_mb']:8.1f} MB  {r['ms_per_recipe']:8.3f} ms/recipe")
+        report["results"].extend(results)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Convert Paprika exports to PDF cookbooks from the command line, without the web app.
+
+    $ python convert.py exports/ more.paprikarecipes --output-dir pdfs --workers 4 --memory-mb 2048 --profile print
+
+Every export is converted in its own process; --memory-mb caps the address space of
+each conversion. A summary with per-stage timings is printed for every file.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cookbook
+
+def find_exports(paths):
+    exports = []
+    for path in paths:
+        if os.path.isdir(path):
+            exports.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.paprikarecipes')))
+        else:
+            exports.append(path)
+    return exports
+
+def output_paths(exports, output_dir):
+    # <export name>.pdf, numbered when two exports share a name
+    taken = set()
+    paths = {}
+    for export in exports:
+        stem = os.path.splitext(os.path.basename(export))[0]
+        name, n = f"{stem}.pdf", 1
+        while name in taken:
+            n += 1
+            name = f"{stem}_{n}.pdf"
+        taken.add(name)
+        paths[export] = os.path.join(output_dir, name)
+    return paths
+
+def init_worker(image_workers):
+    # Parallel conversions share the CPUs instead of each starting a full image pool
+    cookbook.IMAGE_WORKERS = image_workers
+
+def convert(export, pdf_path, user_name, memory_mb, profile=cookbook.DEFAULT_PROFILE):
+    started = time.perf_counter()
+    result = {'export': export, 'status': 'error', 'error': None, 'output': None, 'stats': {}}
+    try:
+        _, _, cost_mb = cookbook.validate_upload(export, profile)
+    except (cookbook.UploadError, OSError) as e:
+        result['error'] = str(e)
+        return result
+    if memory_mb and cost_mb > memory_mb:
+        result['error'] = f'Estimated to need {cost_mb:.0f} MB, more than --memory-mb {memory_mb}'
+        return result
+    if memory_mb:
+        # Inherited by the image and chapter pools of this conversion
+        limit = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    job_dir = tempfile.mkdtemp(prefix="paprika_cli_", dir=cookbook.BASE_TEMP_DIR)
+    try:
+        # process_cookbook removes the ZIP it is given
+        zip_path = os.path.join(job_dir, "upload.zip")
+        cookbook.link_or_copy(export, zip_path)
+        job = {}
+        cookbook.process_cookbook(job, zip_path, user_name, job_dir, profile)
+        result['stats'] = json.loads(job.get('stats') or '{}')
+        if job.get('status') == 'complete':
+            shutil.move(job['pdf_path'], pdf_path)
+            result['status'] = 'complete'
+            result['output'] = pdf_path
+        else:
+            result['error'] = job.get('error')
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    result['seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+def print_result(result):
+    stats = result['stats']
+    if result['status'] == 'complete':
+        print(f"OK    {result['export']} -> {result['output']}: {stats.get('recipes', 0)} recipes, "
+              f"{stats.get('pages', 0)} pages, {result['seconds']:.1f}s")
+    else:
+        print(f"FAIL  {result['export']}: {result['error']}")
+    stages = stats.get('stages', {})
+    if stages:
+        print("      " + ", ".join(f"{name} {measured['seconds']:.1f}s" for name, measured in stages.items()))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help=".paprikarecipes files or directories containing them")
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--name", default="A Food Lover", help="name on the cover")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="exports converted at the same time")
+    parser.add_argument("--profile", default=cookbook.DEFAULT_PROFILE, choices=list(cookbook.RENDER_PROFILES))
+    parser.add_argument("--memory-mb", type=int, default=0, help="address space limit per conversion (0: none)")
+    args = parser.parse_args()
+
+    exports = find_exports(args.paths)
+    if not exports:
+        parser.error("no .paprikarecipes files found")
+    os.makedirs(args.output_dir, exist_ok=True)
+    pdf_paths = output_paths(exports, args.output_dir)
+    workers = max(1, min(args.workers, len(exports)))
+    image_workers = max(1, (os.cpu_count() or 1) // workers)
+
+    started = time.perf_counter()
+    failed = 0
+    # One process per export, so memory limits and leaks end with the conversion
+    with ProcessPoolExecutor(max_workers=workers, max_tasks_per_child=1,
+                             initializer=init_worker, initargs=(image_workers,)) as pool:
+        futures = {pool.submit(convert, export, pdf_paths[export], args.name, args.memory_mb, args.profile): export for export in exports}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # e.g. the process was killed by the kernel's OOM killer
+                result = {'export': futures[future], 'status': 'error', 'error': f"{type(e).__name__}: {e}", 'stats': {}}
+            failed += result['status'] != 'complete'
+            print_result(result)
+
+    print(f"{len(exports) - failed}/{len(exports)} converted in {time.perf_counter() - started:.1f}s")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1025 @@
+"""Paprika export -> PDF cookbook pipeline, shared by the web app and the render workers."""
+import os
+import zipfile
+import json
+import base64
+import html
+import zlib
+import hashlib
+import datetime
+import uuid
+import tempfile
+import io
+import shutil
+import time
+import resource
+import subprocess
+import re
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from itertools import groupby  # <--- NEU: Für die Gruppierung der Kapitel
+from operator import attrgetter
+from weasyprint import CSS, HTML, __version__ as WEASYPRINT_VERSION
+from weasyprint.text.fonts import FontConfiguration
+from PIL import Image
+from pypdf import PdfReader, PdfWriter
+from pypdf.annotations import Link
+
+# --- Configuration ---
+BASE_TEMP_DIR = tempfile.gettempdir()
+# Web jobs get a directory named by their job id in here; storage.py removes those
+# without a job, so nothing else may live in it
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(BASE_TEMP_DIR, "paprika_jobs"))
+MAX_IMAGE_WIDTH = 600
+JPEG_QUALITY = 70
+# Progressive, Huffman-optimized JPEGs: a little smaller, a little slower to encode
+JPEG_PROGRESSIVE = os.environ.get("JPEG_PROGRESSIVE", "0") != "0"
+# Photos with more pixels are skipped (decompression bombs); 50 MP covers any camera
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 50_000_000))
+# Processes decoding and resizing photos during extraction
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", os.cpu_count() or 1))
+IMAGE_QUEUE_DEPTH = 4
+# Optimized photos shared across jobs, keyed by content hash (storage.PROTECTED_PATHS keeps
+# the storage sweep away from it and the other shared directories)
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join(BASE_TEMP_DIR, "paprika_image_cache"))
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("IMAGE_CACHE_MAX_MB", 512)) * 1024 * 1024
+# Render each chapter as its own document and merge them (keeps peak memory per chapter)
+CHUNKED_RENDERING = os.environ.get("CHUNKED_RENDERING", "1") != "0"
+# Number of processes laying out chapters in parallel (chunked rendering only)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 1))
+# Reuse chapter PDFs of earlier conversions when a chapter's recipes did not change (chunked rendering only)
+INCREMENTAL_RENDERING = os.environ.get("INCREMENTAL_RENDERING", "1") != "0"
+CHAPTER_CACHE_DIR = os.environ.get("CHAPTER_CACHE_DIR", os.path.join(BASE_TEMP_DIR, "paprika_chapter_cache"))
+CHAPTER_CACHE_MAX_BYTES = int(os.environ.get("CHAPTER_CACHE_MAX_MB", 1024)) * 1024 * 1024
+# Working files of a job; only the PDF stays in the job directory once it is written
+JOB_INTERMEDIATES = ("images", "chunks", "cookbook.html")
+# Post-render pass over the finished PDF: identical objects (photos above all) stored once,
+# content streams compressed
+PDF_OPTIMIZE = os.environ.get("PDF_OPTIMIZE", "1") != "0"
+# Rewrite the PDF linearized ("fast web view", first page shown before the download ends); needs qpdf
+PDF_LINEARIZE = os.environ.get("PDF_LINEARIZE", "0") != "0"
+# Bundled font files (see fetch_fonts.py); renders never fetch fonts over the network
+FONT_DIR = os.environ.get("FONT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts"))
+# (family, weight, style) of every face used by CSS_STYLES
+FONT_FACES = [
+    ("Playfair Display", 400, "normal"), ("Playfair Display", 700, "normal"), ("Playfair Display", 400, "italic"),
+    ("Lato", 400, "normal"), ("Lato", 700, "normal"),
+    ("Merriweather", 300, "normal"), ("Merriweather", 400, "normal"), ("Merriweather", 700, "normal"), ("Merriweather", 300, "italic"),
+]
+# Rough cost model: base cost of a render plus layout memory per recipe page
+RENDER_BASE_MB = 80
+RENDER_MB_PER_RECIPE = 0.6
+RENDER_MB_PER_PHOTO_MB = 0.25
+# Limits checked against the ZIP central directory before an upload is queued
+MAX_RECIPES = int(os.environ.get("MAX_RECIPES", 10000))
+MAX_UNCOMPRESSED_BYTES = int(os.environ.get("MAX_UNCOMPRESSED_MB", 2048)) * 1024 * 1024
+# Uncompressed / compressed size of a member; photos and gzipped recipes barely compress
+MAX_COMPRESSION_RATIO = 100
+# A single recipe after gunzipping (photo_data included)
+MAX_RECIPE_BYTES = 64 * 1024 * 1024
+
+# --- RENDER PROFILES ---
+# Chosen per job at /upload: image settings, an optional cap on the number of recipes
+# (the first ones in book order), whether chapters open with a title page listing
+# their recipes, and CSS added after CSS_STYLES.
+# Recipes in a 'preview' render
+PREVIEW_RECIPES = int(os.environ.get("PREVIEW_RECIPES", 30))
+RENDER_PROFILES = {
+    'standard': {
+        'image_width': MAX_IMAGE_WIDTH, 'jpeg_quality': JPEG_QUALITY, 'max_recipes': None, 'chapter_pages': True,
+        'css': "",
+    },
+    'preview': {
+        'image_width': 160, 'jpeg_quality': 50, 'max_recipes': PREVIEW_RECIPES, 'chapter_pages': False,
+        'css': ".recipe-card { page-break-after: auto; } .sidebar-image { width: 50%; box-shadow: none; }",
+    },
+    'print': {
+        'image_width': 1200, 'jpeg_quality': 90, 'max_recipes': None, 'chapter_pages': True,
+        'css': ".sidebar-image { box-shadow: none; }",
+    },
+}
+DEFAULT_PROFILE = 'standard'
+
+# --- KOCHBUCH KATEGORIEN ---
+COOKBOOK_ORDER = [
+    "Grundrezepte", "Frühstück", "Vorspeisen", "Suppen", "Salate",
+    "Hauptgerichte", "Beilagen", "Saucen, Dips & Dressings", "Desserts", "Backen"
+]
+# Category -> position in the book; other categories come after these
+CATEGORY_RANK = {category: rank for rank, category in enumerate(COOKBOOK_ORDER)}
+UNRANKED = len(COOKBOOK_ORDER)
+
+# --- CSS STYLES ---
+CSS_STYLES = """
+@media print { 
+    @page { margin: 1.5cm; @bottom-center { content: "Page " counter(page); font-family: 'Lato', sans-serif; font-size: 9pt; color: #999; } } 
+    body { -webkit-print-color-adjust: exact; print-color-adjust: exact; }
+    .no-print { display: none; }
+    .page-break { page-break-after: always; }
+    .avoid-break { page-break-inside: avoid; }
+    .cover-page { page-break-after: always; margin: 0; height: 100%; }
+    .chapter-page { page-break-before: always; page-break-after: always; }
+}
+body { font-family: 'Merriweather', serif; color: #333; line-height: 1.45; margin: 0; padding: 0; background: #fff; }
+.container { max-width: 900px; margin: 0 auto; padding: 20px; }
+
+/* Cover Page */
+.cover-page { text-align: center; padding: 40px 20px; border: 6px double #2c3e50; height: 85vh; display: flex; flex-direction: column; justify-content: center; align-items: center; background-color: #fdfbf7; box-sizing: border-box; margin-bottom: 0; }
+.cover-subtitle { font-family: 'Lato', sans-serif; text-transform: uppercase; letter-spacing: 3px; font-size: 0.9rem; color: #e67e22; margin-bottom: 15px; }
+.cover-title { font-family: 'Playfair Display', serif; font-size: 3.8rem; line-height: 1.1; color: #2c3e50; margin: 10px 0; font-style: italic; }
+.cover-author { font-family: 'Playfair Display', serif; font-size: 1.3rem; color: #555; margin-top: 30px; font-weight: normal; }
+.cover-author strong { display: block; font-size: 1.8rem; color: #2c3e50; margin-top: 8px; }
+.cover-year { margin-top: auto; font-family: 'Lato', sans-serif; color: #999; font-size: 0.8rem; padding-top: 20px; }
+
+/* Chapter Page Styles */
+.chapter-page { display: flex; flex-direction: column; justify-content: center; align-items: center; height: 85vh; background: #2c3e50; color: #fff; text-align: center; border: 4px solid #e67e22; margin: 20px 0; }
+.chapter-content-wrapper { width: 80%; }
+.chapter-title { font-family: 'Playfair Display', serif; font-size: 4rem; color: #fff; border-bottom: 3px solid #e67e22; padding-bottom: 20px; margin-bottom: 20px; }
+
+/* Chapter Mini TOC */
+.chapter-toc { list-style: none; padding: 0; margin-top: 30px; text-align: center; columns: 2; column-gap: 40px; }
+.chapter-toc-item { font-family: 'Lato', sans-serif; font-size: 1.1rem; margin-bottom: 10px; color: #ecf0f1; break-inside: avoid; page-break-inside: avoid; }
+
+/* Main TOC */
+.toc-container { padding: 20px 0; }
+.toc-title { font-family: 'Playfair Display', serif; font-size: 2.2rem; text-align: center; color: #2c3e50; margin-bottom: 30px; border-bottom: 2px solid #e67e22; display: inline-block; padding-bottom: 8px; width: 100%; }
+.toc-list { column-count: 2; column-gap: 40px; list-style: none; padding: 0; font-family: 'Lato', sans-serif; }
+.toc-item { margin-bottom: 6px; break-inside: avoid; page-break-inside: avoid; font-size: 0.9rem; }
+.toc-item a { text-decoration: none; color: #333; display: flex; align-items: baseline; width: 100%; }
+.toc-dots { flex-grow: 1; border-bottom: 1px dotted #aaa; margin: 0 5px; position: relative; top: -4px; }
+.toc-page { font-family: 'Lato', sans-serif; color: #666; font-size: 0.85rem; min-width: 25px; text-align: right; }
+.toc-page::after { content: target-counter(attr(href), page); }
+.toc-category-header { column-span: all; font-family: 'Playfair Display', serif; font-size: 1.2rem; color: #e67e22; margin-top: 15px; margin-bottom: 5px; font-weight: bold; border-bottom: 1px solid #eee; }
+
+/* Recipe Layout */
+.recipe-card { margin-bottom: 30px; padding-bottom: 20px; border-bottom: 1px dashed #ccc; padding-top: 10px; page-break-after: always; }
+h1 { font-family: 'Playfair Display', serif; font-size: 2.0rem; color: #2c3e50; text-align: center; margin-bottom: 5px; margin-top: 0; }
+.meta-info-container { text-align: center; margin-bottom: 15px; }
+.meta-info { display: inline-block; font-family: 'Lato', sans-serif; font-size: 0.8rem; color: #e67e22; text-transform: uppercase; letter-spacing: 1.5px; font-weight: 700; border-top: 1px solid #e67e22; border-bottom: 1px solid #e67e22; padding: 3px 12px; }
+table.layout-table { width: 100%; border-collapse: collapse; border: none; }
+td { vertical-align: top; }
+td.sidebar-cell { width: 30%; padding-right: 20px; }
+td.main-cell { width: 70%; padding-left: 15px; border-left: 1px solid #eee; }
+.sidebar-image { width: 100%; height: auto; border-radius: 4px; margin-bottom: 15px; box-shadow: 0 2px 5px rgba(0,0,0,0.1); border: 3px solid white; }
+h3 { font-family: 'Lato', sans-serif; font-size: 0.95rem; color: #2c3e50; margin-top: 0; text-transform: uppercase; border-bottom: 2px solid #e67e22; padding-bottom: 4px; margin-bottom: 8px; letter-spacing: 0.5px; }
+ul { padding-left: 0; margin: 0; list-style: none; }
+li { margin-bottom: 4px; font-size: 0.9rem; border-bottom: 1px dotted #ddd; padding-bottom: 2px; }
+.step { margin-bottom: 8px; text-align: justify; position: relative; padding-left: 25px; font-size: 0.95rem; }
+.step:before { content: attr(data-step); position: absolute; left: 0; top: 0; font-weight: bold; color: white; background: #e67e22; border-radius: 50%; width: 18px; height: 18px; text-align: center; line-height: 18px; font-size: 0.7rem; font-family: 'Lato', sans-serif; }
+.notes { margin-top: 12px; padding: 10px; background: #fffcf5; font-size: 0.85rem; border-left: 3px solid #e67e22; font-style: italic; }
+.footer { text-align: center; margin-top: 50px; padding-top: 20px; border-top: 1px solid #eee; color: #888; font-family: 'Lato', sans-serif; font-size: 0.8rem; }
+"""
+
+# --- FONTS & STYLESHEETS ---
+
+def font_file_name(family, weight, style):
+    return f"{family.replace(' ', '')}-{weight}{'-italic' if style == 'italic' else ''}.ttf"
+
+def font_face_css():
+    rules = []
+    for family, weight, style in FONT_FACES:
+        path = os.path.join(FONT_DIR, font_file_name(family, weight, style))
+        if not os.path.exists(path):
+            print(f"Font missing, falling back to system fonts: {path}")
+            continue
+        rules.append(f"@font-face {{ font-family: '{family}'; font-weight: {weight}; font-style: {style}; src: url('file://{path}'); }}")
+    return "\n".join(rules)
+
+_styles = {}
+
+def get_stylesheets(extra_css=None):
+    # Fonts and stylesheets are parsed once per process and reused by the renders of
+    # that process. FontConfiguration holds native handles, so forked processes build
+    # their own: every job runs in a fresh process (worker.job_process_main), so this
+    # lasts one job, and each chapter render process (RENDER_WORKERS) builds it again.
+    if _styles.get('pid') != os.getpid():
+        _styles.clear()
+        font_config = FontConfiguration()
+        _styles['font_config'] = font_config
+        _styles['base'] = [CSS(string=font_face_css(), font_config=font_config), CSS(string=CSS_STYLES, font_config=font_config)]
+        _styles['pid'] = os.getpid()
+    stylesheets = _styles['base']
+    if extra_css:
+        if extra_css not in _styles:
+            _styles[extra_css] = CSS(string=extra_css, font_config=_styles['font_config'])
+        stylesheets = stylesheets + [_styles[extra_css]]
+    return _styles['font_config'], stylesheets
+
+def render_document(string=None, filename=None, extra_css=None):
+    # Fonts are embedded as subsets of the used glyphs (WeasyPrint's full_fonts=False)
+    font_config, stylesheets = get_stylesheets(extra_css)
+    source = HTML(string=string) if filename is None else HTML(filename=filename)
+    return source.render(stylesheets=stylesheets, font_config=font_config)
+
+# --- INSTRUMENTATION ---
+
+def reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets VmHWM, so every stage reports its own peak
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # High-water mark of the whole process lifetime (kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def cpu_seconds():
+    # Includes finished child processes, i.e. the image and render pools
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+@contextmanager
+def timed_stage(job, stats, name):
+    # Records wall time, CPU time and peak RSS of one stage in stats['stages'] and
+    # publishes the stats on the job as JSON (a snapshot, safe to flush from other threads).
+    # job['stage'] tells the render worker which stage budget applies.
+    job['stage'] = name
+    reset_peak_rss()
+    started, cpu_started = time.perf_counter(), cpu_seconds()
+    try:
+        yield
+    finally:
+        stats['stages'][name] = {
+            'seconds': round(time.perf_counter() - started, 3),
+            'cpu_seconds': round(cpu_seconds() - cpu_started, 3),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        job['stats'] = json.dumps(stats)
+
+# --- WORKER FUNCTIONS ---
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def image_cache_path(img_data, max_width, quality):
+    # Keyed by the source bytes and the settings that shape the optimized output
+    digest = hashlib.sha256(img_data)
+    digest.update(f"|{max_width}|{quality}|{JPEG_PROGRESSIVE}".encode())
+    key = digest.hexdigest()
+    return key, os.path.join(IMAGE_CACHE_DIR, key[:2], key + ".jpg")
+
+def optimize_and_save_image(image_data, output_dir, max_width=MAX_IMAGE_WIDTH, quality=JPEG_QUALITY):
+    # image_data is either the base64 'photo_data' string or raw bytes of a photo file
+    if not image_data: return None
+    try:
+        img_data = base64.b64decode(image_data) if isinstance(image_data, str) else image_data
+        key, cache_path = image_cache_path(img_data, max_width, quality)
+        filepath = os.path.join(output_dir, key + ".jpg")
+        if os.path.exists(filepath):
+            # Same photo already used by another recipe of this export
+            return filepath
+
+        if os.path.exists(cache_path):
+            os.utime(cache_path)  # mark as recently used for LRU eviction
+        else:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+            # Image.open only reads the header; pixels are decoded on first use
+            with Image.open(io.BytesIO(img_data)) as img:
+                if img.width * img.height > MAX_IMAGE_PIXELS:
+                    raise ValueError(f"{img.width}x{img.height} photo exceeds {MAX_IMAGE_PIXELS} pixels")
+                if img.format == "JPEG" and img.width <= max_width and img.mode in ("RGB", "L"):
+                    # Small enough already: re-encoding would only lose quality
+                    with open(tmp_path, "wb") as f:
+                        f.write(img_data)
+                else:
+                    new_height = int(float(img.height) * max_width / float(img.width))
+                    if img.width > max_width:
+                        # JPEG: let the decoder scale down by 1/2, 1/4 or 1/8 to the smallest
+                        # size that is still at least the target, instead of decoding it all
+                        img.draft(img.mode, (max_width, new_height))
+                    if img.mode in ("RGBA", "P"): img = img.convert("RGB")
+                    if img.width > max_width:
+                        img = img.resize((max_width, new_height), Image.Resampling.LANCZOS)
+
+                    img.save(tmp_path, format="JPEG", quality=quality,
+                             progressive=JPEG_PROGRESSIVE, optimize=JPEG_PROGRESSIVE)
+            os.replace(tmp_path, cache_path)
+
+        # Hard link into the job so cache eviction never pulls a file from under a render
+        link_or_copy(cache_path, filepath)
+        return filepath
+    except Exception as e:
+        print(f"Image Error: {e}")
+        return None
+
+def prune_cache(cache_dir, max_bytes):
+    entries = []
+    total_bytes = 0
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total_bytes += st.st_size
+
+    if total_bytes <= max_bytes:
+        return
+    # Least recently used first
+    entries.sort()
+    for _, size, path in entries:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        if total_bytes <= max_bytes:
+            break
+
+class UploadError(Exception):
+    # An export rejected before it is queued; status is the HTTP status to answer with
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def validate_upload(zip_path, profile_name=DEFAULT_PROFILE):
+    # Checks the ZIP central directory only, nothing is decompressed.
+    # Returns (recipe_count, photo_bytes, cost_mb) or raises UploadError.
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as z:
+            infos = z.infolist()
+    except zipfile.BadZipFile:
+        raise UploadError('The uploaded file is not a ZIP archive')
+
+    recipe_count = 0
+    uncompressed_bytes = 0
+    for info in infos:
+        if info.filename.endswith('.paprikarecipe'):
+            recipe_count += 1
+        uncompressed_bytes += info.file_size
+        if info.file_size > max(info.compress_size, 1) * MAX_COMPRESSION_RATIO:
+            raise UploadError(f'The archive member {info.filename} is suspiciously compressed')
+
+    if recipe_count == 0:
+        raise UploadError('No .paprikarecipe files found in the export')
+    if recipe_count > MAX_RECIPES:
+        raise UploadError(f'This export has {recipe_count} recipes, at most {MAX_RECIPES} can be converted', 413)
+    if uncompressed_bytes > MAX_UNCOMPRESSED_BYTES:
+        raise UploadError(f'This export unpacks to more than {MAX_UNCOMPRESSED_BYTES // (1024 * 1024)} MB', 413)
+
+    # Inline photo_data dominates the size of a recipe member, so count both
+    photo_bytes = uncompressed_bytes
+    # Profiles with a recipe cap only render that share of the export
+    max_recipes = RENDER_PROFILES[profile_name]['max_recipes']
+    share = min(1.0, max_recipes / recipe_count) if max_recipes else 1.0
+    cost_mb = RENDER_BASE_MB + share * (recipe_count * RENDER_MB_PER_RECIPE + (photo_bytes / (1024 * 1024)) * RENDER_MB_PER_PHOTO_MB)
+    return recipe_count, photo_bytes, cost_mb
+
+def result_cache_key(upload_digest, user_name, profile_name=DEFAULT_PROFILE):
+    # Everything that changes the bytes of the finished PDF
+    settings = [upload_digest, user_name, datetime.datetime.now().year, profile_name, RENDER_PROFILES[profile_name],
+                JPEG_PROGRESSIVE, CHUNKED_RENDERING, PDF_OPTIMIZE, PDF_LINEARIZE]
+    return hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()
+
+def process_cookbook(job, zip_path, user_name, job_dir, profile_name=DEFAULT_PROFILE):
+    # job is a mutable mapping that receives status, progress, stats and the result
+    started = time.perf_counter()
+    profile = RENDER_PROFILES[profile_name]
+    stats = {
+        'stages': {}, 'zip_bytes': 0, 'recipes': 0, 'images': 0, 'images_failed': 0,
+        'image_bytes_in': 0, 'image_bytes_out': 0, 'pdf_bytes': 0, 'pdf_bytes_saved': 0,
+    }
+    try:
+        job['status'] = 'processing'
+        job['message'] = 'Extracting recipes...'
+        job['progress'] = 5
+
+        entries = []
+        img_dir = os.path.join(job_dir, "images")
+        os.makedirs(img_dir, exist_ok=True)
+        stats['zip_bytes'] = os.path.getsize(zip_path)
+
+        # Images are decoded and resized in worker processes while parsing continues.
+        # At most IMAGE_QUEUE_DEPTH images per worker are in flight to bound memory.
+        pending_images = []
+        in_flight = set()
+        max_in_flight = IMAGE_WORKERS * IMAGE_QUEUE_DEPTH
+
+        with zipfile.ZipFile(zip_path, 'r') as z:
+            all_zip_files = z.namelist()
+            recipe_files = [f for f in all_zip_files if f.endswith('.paprikarecipe')]
+            # basename -> member, for recipes that reference an external photo file
+            photo_index = {}
+            for f in all_zip_files:
+                photo_index.setdefault(os.path.basename(f), f)
+            
+            total_files = len(recipe_files)
+            if total_files == 0:
+                raise Exception("No .paprikarecipe files found in ZIP")
+
+            max_recipes = profile['max_recipes']
+
+            with ProcessPoolExecutor(max_workers=IMAGE_WORKERS) as image_pool:
+                def submit_image(entry, img_data):
+                    nonlocal in_flight
+                    # base64 text is a third larger than the photo it carries
+                    stats['image_bytes_in'] += len(img_data) * 3 // 4 if isinstance(img_data, str) else len(img_data)
+                    img_future = image_pool.submit(optimize_and_save_image, img_data, img_dir,
+                                                   profile['image_width'], profile['jpeg_quality'])
+                    pending_images.append((entry, img_future))
+                    in_flight.add(img_future)
+                    if len(in_flight) >= max_in_flight:
+                        _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                with timed_stage(job, stats, 'extract'):
+                    # With a recipe cap, photos are read once the kept recipes are known
+                    for idx, entry, img_data in scan_recipes(z, recipe_files, photo_index, with_photos=not max_recipes):
+                        job['progress'] = 10 + int((idx / total_files) * 60)
+                        job['message'] = f'Processing recipe {idx+1}/{total_files}...'
+
+                        entries.append(entry)
+                        if img_data:
+                            submit_image(entry, img_data)
+                            del img_data
+                    if max_recipes:
+                        entries.sort(key=RECIPE_SORT_KEY)
+                        del entries[max_recipes:]
+                        for entry in entries:
+                            img_data = read_recipe_photo(z, entry.member, photo_index)
+                            if img_data:
+                                submit_image(entry, img_data)
+                                del img_data
+                    stats['recipes'] = len(entries)
+
+                with timed_stage(job, stats, 'images'):
+                    job['message'] = 'Optimizing images...'
+                    job['progress'] = 70
+                    image_paths = set()
+                    for entry, img_future in pending_images:
+                        try:
+                            entry.image_path = img_future.result()
+                        except Exception as e:
+                            print(f"Image Error: {e}")
+                        if entry.image_path:
+                            image_paths.add(entry.image_path)
+                        else:
+                            stats['images_failed'] += 1
+                    stats['images'] = len(pending_images)
+                    stats['image_bytes_out'] = sum(os.path.getsize(path) for path in image_paths)
+                    pending_images.clear()
+                    # Reap the workers here so their CPU time counts towards this stage
+                    image_pool.shutdown()
+                    prune_cache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+            with timed_stage(job, stats, 'layout'):
+                job['message'] = 'Sorting and layout...'
+                job['progress'] = 75
+                entries.sort(key=RECIPE_SORT_KEY)
+                assign_anchors(entries)
+
+            def load_chapter(chapter_entries):
+                return load_recipes(z, chapter_entries)
+
+            def stage(name):
+                if name == 'merge':
+                    # Front matter, page numbers and links; long for big tables of contents
+                    job['message'] = 'Assembling the PDF...'
+                    job['progress'] = 95
+                return timed_stage(job, stats, name)
+
+            pdf_filename = f"Cookbook_{uuid.uuid4().hex[:8]}.pdf"
+            pdf_path = os.path.join(job_dir, pdf_filename)
+
+            if CHUNKED_RENDERING:
+                job['message'] = 'Rendering PDF (this takes time)...'
+                job['progress'] = 80
+
+                def chapter_progress(done, total):
+                    job['progress'] = 80 + int((done / total) * 15)
+                    job['message'] = f'Rendering chapter {done}/{total}...'
+
+                stats['pages'], stats['chapters'], stats['chapters_reused'], stats['merge_input_bytes'] = render_chunked_pdf(
+                    entries, load_chapter, user_name, job_dir, pdf_path, profile, progress=chapter_progress, stage=stage)
+            else:
+                job['message'] = 'Generating PDF pages...'
+                job['progress'] = 80
+
+                html_file_path = os.path.join(job_dir, "cookbook.html")
+                with stage('html'), open(html_file_path, "w", encoding="utf-8") as f:
+                    write_full_html(f.write, entries, load_chapter, user_name, profile['chapter_pages'])
+
+                job['message'] = 'Laying out pages (this takes time)...'
+                job['progress'] = 85
+
+                with stage('render'):
+                    document = render_document(filename=html_file_path, extra_css=profile['css'])
+                    stats['pages'] = len(document.pages)
+                    job['message'] = f'Writing {stats["pages"]} pages...'
+                    job['progress'] = 95
+                    document.write_pdf(pdf_path)
+                    del document
+
+        remove_intermediates(job_dir)
+
+        if PDF_OPTIMIZE or PDF_LINEARIZE:
+            job['message'] = 'Optimizing the PDF...'
+            job['progress'] = 98
+            with timed_stage(job, stats, 'optimize'):
+                stats['pdf_bytes_saved'] = optimize_pdf(pdf_path, PDF_OPTIMIZE, PDF_LINEARIZE)
+
+        stats['pdf_bytes'] = os.path.getsize(pdf_path)
+        stats['seconds'] = round(time.perf_counter() - started, 3)
+        job['stats'] = json.dumps(stats)
+        job['filename'] = pdf_filename
+        job['pdf_path'] = pdf_path
+        job['progress'] = 100
+        job['message'] = 'Done!'
+        job['status'] = 'complete'
+
+    except Exception as e:
+        print(f"Job failed: {e}")
+        stats['seconds'] = round(time.perf_counter() - started, 3)
+        job['stats'] = json.dumps(stats)
+        job['error'] = str(e) or type(e).__name__
+        job['status'] = 'error'
+    finally:
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+        remove_intermediates(job_dir)
+
+def remove_intermediates(job_dir):
+    for name in JOB_INTERMEDIATES:
+        path = os.path.join(job_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+# --- PDF OPTIMIZATION ---
+
+def linearize_pdf(src_path, dst_path):
+    if not shutil.which("qpdf"):
+        print("PDF Optimize Error: PDF_LINEARIZE needs qpdf, which is not installed")
+        return False
+    # Exit status 3: written, with warnings
+    return subprocess.run(["qpdf", "--linearize", src_path, dst_path]).returncode in (0, 3)
+
+def optimize_pdf(pdf_path, dedupe=True, linearize=False):
+    # Rewrites pdf_path in place and returns the bytes saved. The PDF is kept as it is
+    # when the pass fails or would not make it smaller (linearizing may add a little).
+    size_before = os.path.getsize(pdf_path)
+    current = pdf_path
+    written = []
+    try:
+        if dedupe:
+            writer = PdfWriter(clone_from=pdf_path)
+            for page in writer.pages:
+                page.compress_content_streams()
+            # A chunked render embeds a photo once per part it appears in, and a photo
+            # shared by several recipes in different chapters once per chapter
+            writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+            deduped = pdf_path + ".dedupe"
+            written.append(deduped)
+            with open(deduped, "wb") as f:
+                writer.write(f)
+            del writer
+            if os.path.getsize(deduped) < size_before:
+                current = deduped
+        if linearize:
+            linearized = pdf_path + ".linear"
+            written.append(linearized)
+            if linearize_pdf(current, linearized):
+                current = linearized
+        if current != pdf_path:
+            os.replace(current, pdf_path)
+    except Exception as e:
+        print(f"PDF Optimize Error: {e}")
+    finally:
+        for path in written:
+            if os.path.exists(path):
+                os.remove(path)
+    return size_before - os.path.getsize(pdf_path)
+
+# --- RECIPE INGESTION ---
+# A first pass over the ZIP keeps only a RecipeEntry per recipe. Full recipes are
+# re-read from the ZIP and rendered chapter by chapter, so the heap does not grow
+# with ingredient and direction texts of the whole book.
+
+def collation_key(text):
+    # Case- and accent-insensitive, so "äpfel" sorts with "Apfel" and not after "Zucchini".
+    # Deliberately not locale.strxfrm: the order must not depend on the host's locale.
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+class RecipeEntry:
+    __slots__ = ('member', 'name', 'category', 'uid', 'sort_key', 'image_path', 'anchor_id', 'fingerprint')
+
+    def __init__(self, member, name, category, fingerprint=None, uid=None):
+        self.member = member
+        self.name = name
+        self.category = category
+        self.uid = uid
+        # Computed once; ties fall back to the exact strings, then the ZIP member,
+        # so the order is total and the same on every run
+        self.sort_key = (CATEGORY_RANK.get(category, UNRANKED), collation_key(category), category,
+                         collation_key(name), name, member)
+        self.image_path = None
+        self.anchor_id = None
+        # Content hash of the recipe JSON; stable across exports, unlike the gzip bytes
+        self.fingerprint = fingerprint
+
+# Sort is crucial for groupby to work later
+RECIPE_SORT_KEY = attrgetter('sort_key')
+
+def read_recipe_json(z, member):
+    raw_data = z.read(member)
+    try:
+        # Bounded, the ZIP central directory does not show what the gzip layer unpacks to
+        json_bytes = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(raw_data, MAX_RECIPE_BYTES + 1)
+    except zlib.error:
+        json_bytes = raw_data
+    if len(json_bytes) > MAX_RECIPE_BYTES:
+        raise ValueError(f"{member} is larger than {MAX_RECIPE_BYTES // (1024 * 1024)} MB")
+    return json_bytes
+
+def read_recipe_data(z, member):
+    return json.loads(read_recipe_json(z, member).decode('utf-8'))
+
+def primary_category(data):
+    raw_categories = data.get('categories', [])
+    if raw_categories:
+        return min(raw_categories, key=lambda cat: CATEGORY_RANK.get(cat, UNRANKED))
+    return "Sonstiges"
+
+def recipe_photo(z, data, photo_index):
+    # The base64 'photo_data' string or the bytes of the referenced photo file, or None
+    img_data = data.get('photo_data') or data.get('photoData')
+    if not img_data and data.get('photo'):
+        found = photo_index.get(os.path.basename(data['photo']))
+        if found:
+            img_data = z.read(found)
+    return img_data
+
+def read_recipe_photo(z, member, photo_index):
+    try:
+        return recipe_photo(z, read_recipe_data(z, member), photo_index)
+    except Exception as e:
+        print(f"Image Error: {e}")
+        return None
+
+def scan_recipes(z, recipe_files, photo_index, with_photos=True):
+    # Yields (index in recipe_files, RecipeEntry, photo data or None) per readable recipe
+    for idx, member in enumerate(recipe_files):
+        try:
+            json_bytes = read_recipe_json(z, member)
+            data = json.loads(json_bytes.decode('utf-8'))
+            fingerprint = hashlib.sha256(json_bytes).hexdigest()
+            del json_bytes
+
+            img_data = recipe_photo(z, data, photo_index) if with_photos else None
+            entry = RecipeEntry(member, data.get('name', 'Untitled'), primary_category(data), fingerprint, data.get('uid'))
+        except Exception as e:
+            print(f"Skipping corrupt recipe: {e}")
+            continue
+        del data
+        yield idx, entry, img_data
+
+def load_recipes(z, entries):
+    # Full recipe dicts for the given entries, in the same order
+    for entry in entries:
+        data = read_recipe_data(z, entry.member)
+        yield {
+            'name': entry.name,
+            'category': entry.category,
+            'anchor_id': entry.anchor_id,
+            'prep_time': data.get('prep_time', ''),
+            'cook_time': data.get('cook_time', ''),
+            'servings': data.get('servings', ''),
+            'image_path': entry.image_path,
+            'ingredients_list': (data.get('ingredients') or "").split('\n'),
+            'directions_list': (data.get('directions') or "").split('\n'),
+            'notes': data.get('notes', '')
+        }
+
+# --- HTML TEMPLATES ---
+# Filled with str.format; callers escape every value. Styles are not inlined, the
+# pre-parsed stylesheets from get_stylesheets() are passed to each render instead.
+DOCUMENT_START = '<!DOCTYPE html><html><head><meta charset="UTF-8"></head><body><div class="container">'
+DOCUMENT_END = '</div></body></html>'
+COVER_TEMPLATE = '<div class="cover-page"><div class="cover-subtitle">Personal</div><div class="cover-title">Recipe<br>Collection</div><div class="cover-icon">♨</div><div class="cover-author">from<br><strong>{user_name}</strong></div><div class="cover-year">{year}</div></div>'
+TOC_START = '<div class="toc-container"><div class="toc-title">Table of Contents</div><ul class="toc-list">'
+TOC_END = '</ul></div><div class="page-break"></div>'
+TOC_HEADER_TEMPLATE = '<li class="toc-category-header">{category}</li>'
+TOC_ITEM_TEMPLATE = '<li class="toc-item"><a href="#{anchor_id}"><span>{name}</span><span class="toc-dots"></span>{page}</a></li>'
+TOC_PAGE_TEMPLATE = '<span class="toc-page" href="#{anchor_id}"></span>'
+TOC_STATIC_PAGE_TEMPLATE = '<span class="toc-page toc-page-static">{page_number}</span>'
+CHAPTER_START_TEMPLATE = '<div class="chapter-page"><div class="chapter-content-wrapper"><div class="chapter-title">{category}</div><ul class="chapter-toc">'
+CHAPTER_TOC_ITEM_TEMPLATE = '<li class="chapter-toc-item">{name}</li>'
+CHAPTER_END = '</ul></div></div>'
+RECIPE_CARD_TEMPLATE = '<div class="recipe-card avoid-break" id="{anchor_id}"><h1>{name}</h1><div class="meta-info-container"><div class="meta-info">{meta}</div></div><table class="layout-table"><tr><td class="sidebar-cell">{image}<h3>Ingredients</h3><ul>{ingredients}</ul></td><td class="main-cell"><h3>Directions</h3>{directions}{notes}</td></tr></table></div>'
+IMAGE_TEMPLATE = '<img src="file://{path}" class="sidebar-image">'
+INGREDIENT_TEMPLATE = '<li>{}</li>'
+STEP_TEMPLATE = '<div class="step" data-step="{}">{}</div>'
+NOTES_TEMPLATE = '<div class="notes"><strong>Note:</strong> {}</div>'
+FOOTER_TEMPLATE = '<div class="footer no-print">Compiled by {user_name}</div>'
+
+# Every writer below takes a write callable, e.g. list.append or file.write.
+# The TOC and chapter headers work on RecipeEntry objects, recipe cards on the full
+# recipe dicts from load_recipes().
+
+def assign_anchors(entries):
+    # Stable across runs and unique: from the Paprika uid, else the recipe's content
+    # hash. Call on sorted entries, duplicates are numbered in book order.
+    taken = set()
+    for entry in entries:
+        source = entry.uid or entry.fingerprint or hashlib.sha256(entry.member.encode('utf-8')).hexdigest()
+        base = "recipe_" + re.sub(r'[^A-Za-z0-9_-]', '-', str(source))
+        anchor_id, n = base, 1
+        while anchor_id in taken:
+            n += 1
+            anchor_id = f"{base}_{n}"
+        taken.add(anchor_id)
+        entry.anchor_id = anchor_id
+
+# 1. Cover Page
+def write_cover(write, user_name):
+    write(COVER_TEMPLATE.format(user_name=html.escape(user_name), year=datetime.datetime.now().year))
+
+# 2. Main Global TOC
+def write_toc(write, entries, page_numbers=None):
+    # Without page_numbers WeasyPrint resolves them via target-counter(). The chunked
+    # renderer knows them only after layout and passes them in as static text.
+    format_item = TOC_ITEM_TEMPLATE.format
+    format_page = TOC_PAGE_TEMPLATE.format if page_numbers is None else TOC_STATIC_PAGE_TEMPLATE.format
+    write(TOC_START)
+    last_cat = None
+    for entry in entries:
+        current_cat = entry.category
+        if current_cat != last_cat:
+            write(TOC_HEADER_TEMPLATE.format(category=html.escape(current_cat)))
+            last_cat = current_cat
+
+        anchor_id = entry.anchor_id
+        if page_numbers is None:
+            page_html = format_page(anchor_id=anchor_id)
+        else:
+            page_html = format_page(page_number=page_numbers.get(anchor_id, ""))
+        write(format_item(anchor_id=anchor_id, name=html.escape(entry.name), page=page_html))
+    write(TOC_END)
+
+# 3. Chapter page with Mini-TOC, followed by its recipe cards
+def write_chapter(write, category, entries, recipes, chapter_page=True):
+    if chapter_page:
+        write(CHAPTER_START_TEMPLATE.format(category=html.escape(category)))
+        for entry in entries:
+            write(CHAPTER_TOC_ITEM_TEMPLATE.format(name=html.escape(entry.name)))
+        write(CHAPTER_END)
+
+    for recipe in recipes:
+        write_recipe_card(write, recipe)
+
+def write_recipe_card(write, recipe):
+    img_html = ""
+    if recipe.get('image_path'):
+        img_html = IMAGE_TEMPLATE.format(path=html.escape(os.path.abspath(recipe['image_path'])))
+
+    ing_html = "".join([INGREDIENT_TEMPLATE.format(html.escape(i)) for i in recipe['ingredients_list'] if i.strip()])
+
+    steps = [step for step in recipe['directions_list'] if step.strip()]
+    dir_html = "".join([STEP_TEMPLATE.format(idx, html.escape(step)) for idx, step in enumerate(steps, 1)])
+
+    meta = []
+    if recipe.get('prep_time'): meta.append(f"Prep: {html.escape(str(recipe['prep_time']))}")
+    if recipe.get('cook_time'): meta.append(f"Cook: {html.escape(str(recipe['cook_time']))}")
+    if recipe.get('servings'): meta.append(f"Serv.: {html.escape(str(recipe['servings']))}")
+    meta_html = " &nbsp;&bull;&nbsp; ".join(meta) if meta else "&nbsp;"
+
+    notes_html = NOTES_TEMPLATE.format(html.escape(recipe['notes'])) if recipe.get('notes') else ""
+
+    write(RECIPE_CARD_TEMPLATE.format(
+        anchor_id=recipe.get('anchor_id', ''), name=html.escape(recipe['name']), meta=meta_html,
+        image=img_html, ingredients=ing_html, directions=dir_html, notes=notes_html))
+
+def write_full_html(write, entries, load_chapter, user_name, chapter_pages=True):
+    # entries are sorted and have anchors; load_chapter(entries) yields their full recipes
+    write(DOCUMENT_START)
+    write_cover(write, user_name)
+    write_toc(write, entries)
+
+    for category, group in groupby(entries, key=attrgetter('category')):
+        chapter_entries = list(group)
+        write_chapter(write, category, chapter_entries, load_chapter(chapter_entries), chapter_pages)
+
+    write(FOOTER_TEMPLATE.format(user_name=html.escape(user_name)))
+    write(DOCUMENT_END)
+
+# --- CHUNKED RENDERING ---
+# Every chapter is laid out as its own WeasyPrint document, so peak memory depends on
+# the largest chapter instead of the whole book. Chapter documents are rendered without
+# the running footer; page numbers are stamped onto the merged PDF from a "folio"
+# document that holds nothing but the @page footer.
+
+CHUNK_CSS = "@page { @bottom-center { content: none; } }"
+FRONT_MATTER_CSS = ".toc-page-static::after { content: none; }"
+# The folio is merged on top of the rendered pages: no canvas background (body's white
+# would be copied to the whole page), only the page number
+FOLIO_CSS = "html, body { background: none; } .folio + .folio { page-break-before: always; }"
+# Front matter re-renders before giving up on a table of contents that keeps growing
+MAX_FRONT_MATTER_PASSES = 5
+PX_TO_PT = 0.75
+
+def render_chapter_pdf(html_path, pdf_path, extra_css=CHUNK_CSS):
+    document = render_document(filename=html_path, extra_css=extra_css)
+    anchor_pages = {}
+    for page_index, page in enumerate(document.pages):
+        for anchor_id in page.anchors:
+            anchor_pages.setdefault(anchor_id, page_index)
+    document.write_pdf(pdf_path)
+    return len(document.pages), anchor_pages
+
+# --- CHAPTER CACHE ---
+# Chapters carry no page numbers, so a chapter's PDF is the same in every book that
+# contains exactly that chapter. A re-uploaded export only lays out changed chapters.
+
+# Bump when the chapter writers change in a way the templates and styles do not show
+CHAPTER_CACHE_VERSION = 1
+
+def chapter_cache_key(category, entries, profile):
+    settings = [
+        CHAPTER_CACHE_VERSION, WEASYPRINT_VERSION, CSS_STYLES, CHUNK_CSS, FONT_FACES, profile, JPEG_PROGRESSIVE,
+        DOCUMENT_START, CHAPTER_START_TEMPLATE, CHAPTER_TOC_ITEM_TEMPLATE, RECIPE_CARD_TEMPLATE,
+        IMAGE_TEMPLATE, INGREDIENT_TEMPLATE, STEP_TEMPLATE, NOTES_TEMPLATE,
+    ]
+    # Image file names are content hashes of the optimized photos
+    recipes = [(entry.fingerprint, os.path.basename(entry.image_path or '')) for entry in entries]
+    return hashlib.sha256(json.dumps([settings, category, recipes]).encode('utf-8')).hexdigest()
+
+def chapter_cache_path(cache_key):
+    return os.path.join(CHAPTER_CACHE_DIR, cache_key[:2], cache_key)
+
+def anchor_pages_of(entries, entry_pages):
+    # Cached chapters store page indexes by recipe position; anchors may differ between books
+    anchor_pages = {}
+    for entry, page_index in zip(entries, entry_pages):
+        if page_index is not None:
+            anchor_pages.setdefault(entry.anchor_id, page_index)
+    return anchor_pages
+
+def fetch_cached_chapter(cache_key, pdf_path):
+    # Links the cached PDF to pdf_path and returns (page_count, entry_pages), or None
+    base = chapter_cache_path(cache_key)
+    try:
+        with open(base + ".json") as f:
+            meta = json.load(f)
+        link_or_copy(base + ".pdf", pdf_path)
+        os.utime(base + ".pdf")  # mark as recently used for LRU eviction
+        os.utime(base + ".json")
+    except (OSError, ValueError):
+        return None
+    return meta['pages'], meta['entry_pages']
+
+def store_cached_chapter(cache_key, pdf_path, page_count, entry_pages):
+    base = chapter_cache_path(cache_key)
+    try:
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        tmp_path = f"{base}.{uuid.uuid4().hex}.tmp"
+        link_or_copy(pdf_path, tmp_path)
+        os.replace(tmp_path, base + ".pdf")
+        # Written last: a chapter counts as cached once its metadata exists
+        with open(tmp_path, "w") as f:
+            json.dump({'pages': page_count, 'entry_pages': entry_pages}, f)
+        os.replace(tmp_path, base + ".json")
+    except OSError as e:
+        print(f"Chapter Cache Error: {e}")
+
+def render_front_matter_pdf(entries, user_name, page_numbers, pdf_path, extra_css=FRONT_MATTER_CSS):
+    content = [DOCUMENT_START]
+    write_cover(content.append, user_name)
+    write_toc(content.append, entries, page_numbers)
+    content.append(DOCUMENT_END)
+    document = render_document(string="".join(content), extra_css=extra_css)
+    del content
+    # TOC links point into the chapter documents; they are re-created after the merge.
+    toc_links = []
+    for page_index, page in enumerate(document.pages):
+        for link_type, target, (x1, y1, x2, y2), _ in page.links:
+            if link_type == 'internal':
+                rect = (x1 * PX_TO_PT, (page.height - y2) * PX_TO_PT, x2 * PX_TO_PT, (page.height - y1) * PX_TO_PT)
+                toc_links.append((page_index, target, rect))
+        page.links = [link for link in page.links if link[0] != 'internal']
+    document.write_pdf(pdf_path)
+    return len(document.pages), toc_links
+
+def render_chunked_pdf(entries, load_chapter, user_name, job_dir, pdf_path, profile, progress=None, stage=None):
+    # entries are sorted and have anchors; load_chapter(entries) yields their full recipes.
+    # stage(name) returns a context manager timing the 'html', 'render' and 'merge' steps.
+    # Returns (total pages, chapters, chapters reused from the cache, bytes of the merged parts).
+    stage = stage or (lambda name: nullcontext())
+    # The profile's CSS goes into every part, the folio too, so page boxes match
+    chapter_css, front_css, folio_css = (profile['css'] + css for css in (CHUNK_CSS, FRONT_MATTER_CSS, FOLIO_CSS))
+    chunk_dir = os.path.join(job_dir, "chunks")
+    os.makedirs(chunk_dir, exist_ok=True)
+
+    # Chapter HTML goes straight to disk, one chapter's recipes in memory at a time.
+    # Chapters found in the cache are neither written nor laid out.
+    with stage('html'):
+        chapters = []  # (entries, PDF path, cache key)
+        chapter_results = []  # (page_count, anchor_pages), None until rendered
+        render_jobs = []  # (chapter index, HTML path)
+        for idx, (category, group) in enumerate(groupby(entries, key=attrgetter('category'))):
+            chapter_entries = list(group)
+            chapter_path = os.path.join(chunk_dir, f"chapter_{idx:04d}.pdf")
+            cache_key = chapter_cache_key(category, chapter_entries, profile) if INCREMENTAL_RENDERING else None
+            cached = fetch_cached_chapter(cache_key, chapter_path) if cache_key else None
+            chapters.append((chapter_entries, chapter_path, cache_key))
+            if cached:
+                page_count, entry_pages = cached
+                chapter_results.append((page_count, anchor_pages_of(chapter_entries, entry_pages)))
+                continue
+            chapter_results.append(None)
+
+            html_path = os.path.join(chunk_dir, f"chapter_{idx:04d}.html")
+            with open(html_path, "w", encoding="utf-8") as f:
+                f.write(DOCUMENT_START)
+                write_chapter(f.write, category, chapter_entries, load_chapter(chapter_entries), profile['chapter_pages'])
+                f.write(DOCUMENT_END)
+            render_jobs.append((idx, html_path))
+
+    with stage('render'):
+        reused = len(chapters) - len(render_jobs)
+        if progress and reused: progress(reused, len(chapters))
+        html_paths = [html_path for _, html_path in render_jobs]
+        chapter_paths = [chapters[idx][1] for idx, _ in render_jobs]
+        parallel = RENDER_WORKERS > 1 and len(render_jobs) > 1
+        with ProcessPoolExecutor(max_workers=RENDER_WORKERS) if parallel else nullcontext() as pool:
+            css = [chapter_css] * len(render_jobs)
+            results = (pool.map if parallel else map)(render_chapter_pdf, html_paths, chapter_paths, css)
+            for done, ((idx, _), result) in enumerate(zip(render_jobs, results), reused + 1):
+                chapter_results[idx] = result
+                chapter_entries, chapter_path, cache_key = chapters[idx]
+                if cache_key:
+                    page_count, anchor_pages = result
+                    store_cached_chapter(cache_key, chapter_path, page_count, [anchor_pages.get(entry.anchor_id) for entry in chapter_entries])
+                if progress: progress(done, len(chapters))
+        if INCREMENTAL_RENDERING:
+            prune_cache(CHAPTER_CACHE_DIR, CHAPTER_CACHE_MAX_BYTES)
+
+    with stage('merge'):
+        # The TOC length decides where the first chapter starts, and the TOC shows absolute
+        # page numbers. Re-render it until it fits the pages reserved for it (normally
+        # twice). The reservation only grows, so this settles; a TOC that comes out
+        # shorter than reserved is padded with blank pages below.
+        front_path = os.path.join(chunk_dir, "front_matter.pdf")
+        front_pages = 2
+        for _ in range(MAX_FRONT_MATTER_PASSES):
+            page_numbers = {}
+            offset = front_pages
+            for page_count, anchor_pages in chapter_results:
+                for anchor_id, page_index in anchor_pages.items():
+                    page_numbers.setdefault(anchor_id, offset + page_index + 1)
+                offset += page_count
+            rendered_pages, toc_links = render_front_matter_pdf(entries, user_name, page_numbers, front_path, front_css)
+            if rendered_pages <= front_pages:
+                break
+            front_pages = rendered_pages
+        else:
+            raise RuntimeError(f"The table of contents did not settle after {MAX_FRONT_MATTER_PASSES} layouts")
+        total_pages = offset
+
+        folio_path = os.path.join(chunk_dir, "folio.pdf")
+        render_document(string=DOCUMENT_START + '<div class="folio"></div>' * total_pages + DOCUMENT_END, extra_css=folio_css).write_pdf(folio_path)
+
+        writer = PdfWriter()
+        writer.append(front_path)
+        for _ in range(front_pages - rendered_pages):
+            writer.add_blank_page()
+        for _, chapter_path, _ in chapters:
+            writer.append(chapter_path)
+
+        # Known limit: the writer holds the streams of all parts until it is written, so
+        # this stage's peak grows with merge_input_bytes (the whole book) rather than the
+        # largest chapter; so does optimize_pdf, which loads the merged PDF again
+        merge_input_bytes = sum(os.path.getsize(path) for path in [front_path] + [path for _, path, _ in chapters])
+        folio = PdfReader(folio_path)
+        for page_index in range(front_pages, total_pages):
+            page = writer.pages[page_index]
+            page.merge_page(folio.pages[page_index])
+            page.compress_content_streams()
+
+        for page_index, anchor_id, rect in toc_links:
+            if anchor_id in page_numbers:
+                writer.add_annotation(page_index, Link(rect=rect, target_page_index=page_numbers[anchor_id] - 1))
+
+        with open(pdf_path, "wb") as f:
+            writer.write(f)
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    return total_pages, len(chapters), reused, merge_input_bytes
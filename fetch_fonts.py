@@ -0,0 +1,40 @@
+"""Download the font files listed in cookbook.FONT_FACES into FONT_DIR.
+
+Run once at build time (the Dockerfile does), so renders never need network access:
+
+    $ python fetch_fonts.py
+"""
+import os
+import re
+import urllib.request
+from collections import defaultdict
+
+from cookbook import FONT_DIR, FONT_FACES, font_file_name
+
+# The CSS API answers clients without a browser User-Agent with plain TTF files
+GOOGLE_FONTS_CSS = "https://fonts.googleapis.com/css?family={}"
+FONT_FACE_RULE = re.compile(r"@font-face\s*{([^}]*)}")
+
+def fetch(url):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return response.read()
+
+def main():
+    os.makedirs(FONT_DIR, exist_ok=True)
+    variants = defaultdict(list)
+    for family, weight, style in FONT_FACES:
+        variants[family].append(f"{weight}{'italic' if style == 'italic' else ''}")
+
+    for family, family_variants in variants.items():
+        css = fetch(GOOGLE_FONTS_CSS.format(f"{family.replace(' ', '+')}:{','.join(family_variants)}")).decode('utf-8')
+        for rule in FONT_FACE_RULE.findall(css):
+            weight = int(re.search(r"font-weight:\s*(\d+)", rule).group(1))
+            style = re.search(r"font-style:\s*(\w+)", rule).group(1)
+            url = re.search(r"url\(([^)]+)\)", rule).group(1)
+            path = os.path.join(FONT_DIR, font_file_name(family, weight, style))
+            with open(path, "wb") as f:
+                f.write(fetch(url))
+            print(f"{family} {weight} {style} -> {path}")
+
+if __name__ == '__main__':
+    main()
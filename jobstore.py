@@ -0,0 +1,249 @@
+"""SQLite job store shared by the web workers and the render workers."""
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# --- Configuration ---
+DB_PATH = os.environ.get("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "paprika_jobs.sqlite3"))
+# Memory (estimated from the ZIP central directory) that running renders may use together
+RENDER_MEMORY_BUDGET_MB = int(os.environ.get("RENDER_MEMORY_BUDGET_MB", 1536))
+
+# New columns can be appended here; init_db() adds them to existing databases.
+JOB_COLUMNS = {
+    'id': "TEXT PRIMARY KEY",
+    'status': "TEXT NOT NULL DEFAULT 'queued'",
+    'progress': "INTEGER NOT NULL DEFAULT 0",
+    'message': "TEXT NOT NULL DEFAULT ''",
+    'error': "TEXT",
+    'filename': "TEXT",
+    'pdf_path': "TEXT",
+    'created_at': "REAL NOT NULL",
+    'updated_at': "REAL NOT NULL",
+    'cache_key': "TEXT",
+    'zip_path': "TEXT",
+    'user_name': "TEXT",
+    'job_dir': "TEXT",
+    'recipe_count': "INTEGER",
+    'photo_bytes': "INTEGER",
+    'cost_mb': "REAL",
+    'worker_id': "TEXT",
+    # Key of cookbook.RENDER_PROFILES
+    'profile': "TEXT",
+    # Size of the job directory as last measured (see storage.py)
+    'disk_bytes': "INTEGER NOT NULL DEFAULT 0",
+    # Last download or reuse of the result, for LRU eviction
+    'accessed_at': "REAL",
+    # JSON: per-stage timings, memory and counts written by process_cookbook
+    'stats': "TEXT",
+    # Stage process_cookbook is in, checked against the stage budgets by the worker
+    'stage': "TEXT",
+    # Set while a running job is to be stopped; its worker kills it and sets status 'cancelled'
+    'cancel_reason': "TEXT",
+    # Last status poll or progress stream of any client
+    'last_seen_at': "REAL",
+}
+
+# Statuses of jobs that will not change any more
+FINISHED_STATUSES = ('complete', 'error', 'cancelled')
+
+_local = threading.local()
+
+def connection():
+    # One connection per thread and process; forked workers must not reuse the parent's
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid():
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+def init_db():
+    conn = connection()
+    columns = ", ".join(f"{name} {decl}" for name, decl in JOB_COLUMNS.items())
+    conn.execute(f"CREATE TABLE IF NOT EXISTS jobs ({columns})")
+    existing = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+    for name, decl in JOB_COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {decl}")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key)")
+    # Cumulative metric samples (see metrics.py), shared by all processes
+    conn.execute("CREATE TABLE IF NOT EXISTS metrics (name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (name, labels))")
+
+def create_job(job_id, **fields):
+    now = time.time()
+    fields = {'id': job_id, 'created_at': now, 'updated_at': now, **fields}
+    placeholders = ", ".join("?" for _ in fields)
+    connection().execute(f"INSERT INTO jobs ({', '.join(fields)}) VALUES ({placeholders})", list(fields.values()))
+
+def enqueue_job(job_id, cache_key, max_queued, **fields):
+    # Atomically either attach to a finished or running job with the same cache key,
+    # reject because the queue is full, or insert a new queued job.
+    # Returns (job_id, attached); job_id is None when the queue is full.
+    conn = connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        existing = conn.execute(
+            "SELECT id FROM jobs WHERE cache_key = ? AND status NOT IN ('error', 'cancelled') AND cancel_reason IS NULL "
+            "ORDER BY created_at DESC LIMIT 1",
+            (cache_key,)).fetchone()
+        if existing:
+            # Keep a reused result alive for another full cleanup period (queued jobs
+            # keep their created_at, it is their place in the queue)
+            conn.execute("UPDATE jobs SET created_at = ? WHERE id = ? AND status != 'queued'", (time.time(), existing['id']))
+            conn.execute("UPDATE jobs SET accessed_at = ? WHERE id = ?", (time.time(), existing['id']))
+            conn.execute("COMMIT")
+            return existing['id'], True
+        if conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0] >= max_queued:
+            conn.execute("COMMIT")
+            return None, False
+        create_job(job_id, cache_key=cache_key, status='queued', message='Queued...', **fields)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return job_id, False
+
+def get_job(job_id):
+    row = connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_jobs(job_ids):
+    if not job_ids:
+        return []
+    placeholders = ", ".join("?" for _ in job_ids)
+    return [dict(row) for row in connection().execute(f"SELECT * FROM jobs WHERE id IN ({placeholders})", list(job_ids))]
+
+def update_job(job_id, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    connection().execute(f"UPDATE jobs SET {assignments} WHERE id = ?", list(fields.values()) + [job_id])
+
+def delete_job(job_id):
+    connection().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+def touch_job(job_id):
+    # Marks the result as used without counting as a status change
+    connection().execute("UPDATE jobs SET accessed_at = ? WHERE id = ?", (time.time(), job_id))
+
+def mark_seen(job_id):
+    # Not updated_at: that is the heartbeat of the render worker
+    connection().execute("UPDATE jobs SET last_seen_at = ? WHERE id = ?", (time.time(), job_id))
+
+def cancel_job(job_id, reason):
+    # A queued job is cancelled at once ('cancelled'); a running one is flagged for its
+    # worker ('requested'). None when the job has already finished.
+    conn = connection()
+    cursor = conn.execute(
+        "UPDATE jobs SET status = 'cancelled', error = ?, message = 'Cancelled', disk_bytes = 0, updated_at = ? "
+        "WHERE id = ? AND status = 'queued'", (reason, time.time(), job_id))
+    if cursor.rowcount:
+        return 'cancelled'
+    cursor = conn.execute(
+        "UPDATE jobs SET cancel_reason = COALESCE(cancel_reason, ?) WHERE id = ? AND status = 'processing'",
+        (reason, job_id))
+    return 'requested' if cursor.rowcount else None
+
+def finish_cancelled_job(job_id, reason):
+    # Called by the worker once it has stopped the job. False when the job finished first.
+    cursor = connection().execute(
+        "UPDATE jobs SET status = 'cancelled', error = ?, message = 'Cancelled', stage = NULL, disk_bytes = 0, updated_at = ? "
+        "WHERE id = ? AND status = 'processing'", (reason, time.time(), job_id))
+    return cursor.rowcount == 1
+
+def abandoned_jobs(seen_before):
+    # Queued or running jobs no client has asked about since seen_before
+    rows = connection().execute(
+        "SELECT * FROM jobs WHERE status IN ('queued', 'processing') AND COALESCE(last_seen_at, created_at) < ?",
+        (seen_before,)).fetchall()
+    return [dict(row) for row in rows]
+
+def queue_position(job):
+    # Number of queued jobs ahead of this one
+    return connection().execute(
+        "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?",
+        (job['created_at'],)).fetchone()[0]
+
+def claim_job(worker_id):
+    # Take the oldest queued job if its estimate fits the memory budget next to the
+    # running ones. A job always starts when nothing else is running.
+    conn = connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        head = conn.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+        if head is None:
+            conn.execute("COMMIT")
+            return None
+        running, running_mb = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(cost_mb), 0) FROM jobs WHERE status = 'processing'").fetchone()
+        if running and running_mb + (head['cost_mb'] or 0) > RENDER_MEMORY_BUDGET_MB:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'processing', worker_id = ?, updated_at = ? WHERE id = ?",
+            (worker_id, time.time(), head['id']))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    job = dict(head)
+    job['status'] = 'processing'
+    job['worker_id'] = worker_id
+    return job
+
+def fail_stale_jobs(max_age):
+    # Running jobs whose worker stopped sending heartbeats
+    connection().execute(
+        "UPDATE jobs SET status = 'error', error = 'The render worker stopped unexpectedly', updated_at = ? "
+        "WHERE status = 'processing' AND updated_at < ?",
+        (time.time(), time.time() - max_age))
+
+def expired_jobs(created_before):
+    # Finished jobs only; queued and running jobs are never taken away from their worker
+    rows = connection().execute(
+        "SELECT * FROM jobs WHERE status IN ('complete', 'error', 'cancelled') AND created_at < ?", (created_before,)).fetchall()
+    return [dict(row) for row in rows]
+
+def all_jobs():
+    return [dict(row) for row in connection().execute("SELECT * FROM jobs").fetchall()]
+
+def eviction_candidates(keep_cache_key=None):
+    # Finished jobs, least recently completed, downloaded or reused first
+    rows = connection().execute(
+        "SELECT * FROM jobs WHERE status IN ('complete', 'error', 'cancelled') AND (? IS NULL OR cache_key != ?) "
+        "ORDER BY MAX(updated_at, COALESCE(accessed_at, 0))", (keep_cache_key, keep_cache_key)).fetchall()
+    return [dict(row) for row in rows]
+
+def set_disk_bytes(sizes):
+    # sizes: job id -> bytes
+    connection().executemany("UPDATE jobs SET disk_bytes = ? WHERE id = ?", [(size, job_id) for job_id, size in sizes.items()])
+
+def disk_usage():
+    return connection().execute("SELECT COALESCE(SUM(disk_bytes), 0) FROM jobs").fetchone()[0]
+
+def job_counts():
+    # status -> number of jobs
+    return dict(connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+def increment_metrics(samples):
+    # samples are (name, labels, amount); all are added in one transaction
+    conn = connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            "INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) "
+            "ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+            samples)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def metric_samples():
+    # In insertion order, which keeps histogram buckets ascending
+    return [tuple(row) for row in connection().execute("SELECT name, labels, value FROM metrics ORDER BY rowid")]
@@ -0,0 +1,84 @@
+"""Prometheus metrics for /metrics.
+
+Counters and histograms are kept in the job store, so the render workers record
+them and every web worker serves the same totals.
+"""
+import jobstore
+
+# Histogram upper bounds
+STAGE_SECONDS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+JOB_SECONDS_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+PEAK_RSS_MB_BUCKETS = (64, 128, 256, 512, 768, 1024, 1536, 2048, 4096)
+
+# name -> (type, help); also the order of the exposition
+METRICS = {
+    'paprika_jobs_queued': ('gauge', 'Jobs waiting for a render worker'),
+    'paprika_renders_active': ('gauge', 'Jobs being converted right now'),
+    'paprika_job_disk_bytes': ('gauge', 'Disk space of all job directories as last measured'),
+    'paprika_jobs_total': ('counter', 'Finished conversions by result'),
+    'paprika_recipes_total': ('counter', 'Recipes converted'),
+    'paprika_images_total': ('counter', 'Photos optimized'),
+    'paprika_input_bytes_total': ('counter', 'Bytes of uploaded exports converted'),
+    'paprika_output_bytes_total': ('counter', 'Bytes of PDFs written'),
+    'paprika_pdf_bytes_saved_total': ('counter', 'Bytes removed from PDFs by the optimize stage'),
+    'paprika_queue_wait_seconds': ('histogram', 'Time jobs waited for a render worker'),
+    'paprika_job_duration_seconds': ('histogram', 'Wall time of whole conversions'),
+    'paprika_stage_duration_seconds': ('histogram', 'Wall time per conversion stage'),
+    'paprika_stage_peak_rss_megabytes': ('histogram', 'Peak resident memory of the render worker per stage'),
+}
+
+def format_labels(**labels):
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+def observe(samples, name, value, buckets, **labels):
+    # Every bucket gets a sample (0 or 1), so the series exist from the first observation
+    for bound in buckets:
+        samples.append((f"{name}_bucket", format_labels(**labels, le=bound), 1 if value <= bound else 0))
+    samples.append((f"{name}_bucket", format_labels(**labels, le="+Inf"), 1))
+    samples.append((f"{name}_sum", format_labels(**labels), value))
+    samples.append((f"{name}_count", format_labels(**labels), 1))
+
+def record_job(status, queue_wait, stats):
+    # Called by the render worker once a job has finished; stats as built by process_cookbook
+    samples = [('paprika_jobs_total', format_labels(status=status), 1)]
+    observe(samples, 'paprika_queue_wait_seconds', queue_wait, JOB_SECONDS_BUCKETS)
+    if status == 'complete':
+        samples.append(('paprika_recipes_total', '', stats.get('recipes', 0)))
+        samples.append(('paprika_images_total', '', stats.get('images', 0)))
+        samples.append(('paprika_input_bytes_total', '', stats.get('zip_bytes', 0)))
+        samples.append(('paprika_output_bytes_total', '', stats.get('pdf_bytes', 0)))
+        samples.append(('paprika_pdf_bytes_saved_total', '', stats.get('pdf_bytes_saved', 0)))
+        observe(samples, 'paprika_job_duration_seconds', stats.get('seconds', 0), JOB_SECONDS_BUCKETS)
+    for stage, measured in stats.get('stages', {}).items():
+        observe(samples, 'paprika_stage_duration_seconds', measured['seconds'], STAGE_SECONDS_BUCKETS, stage=stage)
+        observe(samples, 'paprika_stage_peak_rss_megabytes', measured['peak_rss_mb'], PEAK_RSS_MB_BUCKETS, stage=stage)
+    jobstore.increment_metrics(samples)
+
+def family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+def format_value(value):
+    return str(int(value)) if value == int(value) else repr(value)
+
+def render_metrics():
+    # Prometheus text exposition format
+    counts = jobstore.job_counts()
+    series = {name: [] for name in METRICS}
+    series['paprika_jobs_queued'].append(('paprika_jobs_queued', '', counts.get('queued', 0)))
+    series['paprika_renders_active'].append(('paprika_renders_active', '', counts.get('processing', 0)))
+    series['paprika_job_disk_bytes'].append(('paprika_job_disk_bytes', '', jobstore.disk_usage()))
+    for sample in jobstore.metric_samples():
+        series.setdefault(family(sample[0]), []).append(sample)
+
+    lines = []
+    for name, samples in series.items():
+        if name in METRICS:
+            kind, help_text = METRICS[name]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        for sample_name, labels, value in samples:
+            lines.append(f"{sample_name}{{{labels}}} {format_value(value)}" if labels else f"{sample_name} {format_value(value)}")
+    return "\n".join(lines) + "\n"
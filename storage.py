@@ -0,0 +1,119 @@
+"""Disk space of job directories: sizes, expiry, a global quota and orphan removal.
+
+The render worker supervisor calls sweep() at startup and then periodically;
+/upload calls evict() to make room before a job is queued.
+
+    DISK_QUOTA_MB=4096 JOB_TTL_SECONDS=3600 python worker.py
+"""
+import os
+import shutil
+import time
+import uuid
+
+import jobstore
+from cookbook import CHAPTER_CACHE_DIR, FONT_DIR, IMAGE_CACHE_DIR, JOBS_DIR
+
+# --- Configuration ---
+# All job directories together (uploads, working files, PDFs); finished results are
+# evicted least recently used first to stay below it
+DISK_QUOTA_BYTES = int(os.environ.get("DISK_QUOTA_MB", 4096)) * 1024 * 1024
+# Finished jobs are removed this long after they were created or last reused
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", 3600))
+STORAGE_SWEEP_SECONDS = 60
+# Job directories without a job are removed only after nothing in them changed for this
+# long: /upload creates the directory while the file is still arriving and inserts the
+# job afterwards
+ORPHAN_GRACE_SECONDS = 600
+# Never job directories, even when configured inside JOBS_DIR
+PROTECTED_PATHS = [IMAGE_CACHE_DIR, CHAPTER_CACHE_DIR, FONT_DIR, jobstore.DB_PATH]
+
+def job_dir(job):
+    return job['job_dir'] or os.path.join(JOBS_DIR, job['id'])
+
+def dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def remove_job(job):
+    shutil.rmtree(job_dir(job), ignore_errors=True)
+    jobstore.delete_job(job['id'])
+
+def evict(needed_bytes=0, keep_cache_key=None):
+    # Removes finished jobs until needed_bytes more fit under the quota; never the one
+    # with keep_cache_key, which an upload may attach to. Returns False when that is
+    # impossible with only queued and running jobs left.
+    usage = jobstore.disk_usage()
+    for job in jobstore.eviction_candidates(keep_cache_key):
+        if usage + needed_bytes <= DISK_QUOTA_BYTES:
+            break
+        print(f"Storage: evicting job {job['id']} ({job['disk_bytes']} bytes)")
+        remove_job(job)
+        usage -= job['disk_bytes']
+    return usage + needed_bytes <= DISK_QUOTA_BYTES
+
+def last_modified(path):
+    # Newest mtime of the directory and everything in it; appending to an upload
+    # does not change the mtime of its directory
+    newest = os.lstat(path).st_mtime
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime)
+            except OSError:
+                pass
+    return newest
+
+def is_protected(path):
+    real = os.path.realpath(path)
+    return any(real == os.path.realpath(p) for p in PROTECTED_PATHS)
+
+def remove_orphans(known_ids):
+    # Directories in JOBS_DIR named like a job id that no job refers to
+    # (e.g. left by a restart while a job was running)
+    removed = 0
+    now = time.time()
+    if not os.path.isdir(JOBS_DIR):
+        return removed
+    for entry in os.scandir(JOBS_DIR):
+        try:
+            uuid.UUID(entry.name)
+        except ValueError:
+            continue
+        if entry.name in known_ids or is_protected(entry.path) or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            if now - last_modified(entry.path) < ORPHAN_GRACE_SECONDS:
+                continue
+        except OSError:
+            continue
+        if jobstore.get_job(entry.name):
+            # Queued since the snapshot was taken
+            continue
+        print(f"Storage: removing orphaned job directory {entry.path}")
+        shutil.rmtree(entry.path, ignore_errors=True)
+        removed += 1
+    return removed
+
+def sweep():
+    for job in jobstore.expired_jobs(time.time() - JOB_TTL_SECONDS):
+        remove_job(job)
+
+    sizes = {}
+    known_ids = set()
+    for job in jobstore.all_jobs():
+        if job['status'] == 'complete' and not (job['pdf_path'] and os.path.exists(job['pdf_path'])):
+            # Result lost, e.g. the temporary directory was wiped
+            remove_job(job)
+            continue
+        known_ids.add(job['id'])
+        sizes[job['id']] = dir_bytes(job_dir(job))
+    jobstore.set_disk_bytes(sizes)
+
+    evict()
+    remove_orphans(known_ids)
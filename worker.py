@@ -0,0 +1,246 @@
+"""Render workers: claim queued jobs from the job store and convert them.
+
+Run next to the web app with ``python worker.py``. The supervisor keeps
+MAX_CONCURRENT_RENDERS worker processes alive, each converting one job at a time
+in a child process that is killed when the job is cancelled or over a stage budget.
+"""
+import cProfile
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+
+import jobstore
+import metrics
+import storage
+from cookbook import DEFAULT_PROFILE, process_cookbook
+
+# --- Configuration ---
+# Worker processes, i.e. conversions running at the same time
+MAX_CONCURRENT_RENDERS = int(os.environ.get("MAX_CONCURRENT_RENDERS", 1))
+POLL_INTERVAL = 1.0
+# Progress is written to the store at most this often; status changes are written at once
+PROGRESS_FLUSH_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 15
+# Running jobs without a heartbeat for this long belong to a dead worker
+STALE_JOB_SECONDS = 120
+SUPERVISOR_INTERVAL = 5
+# Wall-time budget per stage of process_cookbook in seconds (0: none), e.g. RENDER_BUDGET_SECONDS=900.
+# 'render' covers all chapters of a chunked render.
+STAGE_BUDGETS = {
+    stage: int(os.environ.get(f"{stage.upper()}_BUDGET_SECONDS", default))
+    for stage, default in (('extract', 300), ('images', 600), ('layout', 60), ('html', 300),
+                           ('render', 1800), ('merge', 600), ('optimize', 600))
+}
+# Queued and running jobs no client has polled or streamed for this long are cancelled (0: never)
+ABANDONED_JOB_SECONDS = int(os.environ.get("ABANDONED_JOB_SECONDS", 600))
+# How often a worker checks its running job for cancellation and budgets
+MONITOR_INTERVAL = 1.0
+# When set, every job is run under cProfile and its stats are dumped to <PROFILE_DIR>/<job id>.pstats
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+
+class JobUpdates(dict):
+    # The job mapping handed to process_cookbook. Writes are collected and sent to
+    # the store in batches so per-recipe progress does not hammer SQLite.
+    def __init__(self, job_id):
+        super().__init__()
+        self.job_id = job_id
+        self.pending = {}
+        self.last_flush = 0.0
+        self.lock = threading.Lock()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        with self.lock:
+            self.pending[key] = value
+        if key in ('status', 'stage') or time.monotonic() - self.last_flush >= PROGRESS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            fields, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        # Also refreshes updated_at, which serves as the heartbeat
+        jobstore.update_job(self.job_id, **fields)
+
+def send_heartbeats(updates, stop):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        updates.flush()
+
+def run_job(job):
+    queue_wait = time.time() - job['created_at']
+    updates = JobUpdates(job['id'])
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=send_heartbeats, args=(updates, stop), daemon=True)
+    heartbeat.start()
+    # Jobs queued before profiles existed have none
+    profile = job['profile'] or DEFAULT_PROFILE
+    try:
+        if PROFILE_DIR:
+            # Profiles this process only; image and chapter pools are not included
+            profiler = cProfile.Profile()
+            profiler.runcall(process_cookbook, updates, job['zip_path'], job['user_name'], job['job_dir'], profile)
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f"{job['id']}.pstats"))
+        else:
+            process_cookbook(updates, job['zip_path'], job['user_name'], job['job_dir'], profile)
+    finally:
+        stop.set()
+        # Only the PDF is left now; counted towards the disk quota until the next sweep
+        updates['disk_bytes'] = storage.dir_bytes(job['job_dir'])
+        updates.flush()
+    try:
+        metrics.record_job(updates.get('status', 'error'), queue_wait, json.loads(updates.get('stats') or '{}'))
+    except Exception as e:
+        print(f"Metrics Error: {e}")
+
+def job_process_main(job):
+    # Own process group, so stopping the job also stops its image and chapter pools
+    os.setsid()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    run_job(job)
+
+def kill_job_process(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.join()
+
+def cancel_reason(job, stage_started):
+    # Why the running job has to stop, or None
+    if job is None:
+        return 'The job was removed'
+    if job['cancel_reason']:
+        return job['cancel_reason']
+    budget = STAGE_BUDGETS.get(job['stage'])
+    if budget and time.monotonic() - stage_started > budget:
+        return f"Stopped: the {job['stage']} stage took longer than {budget} seconds"
+    return None
+
+def release_cancelled_job(job, reason):
+    # Status, disk space and metrics of a job that was stopped. A queued job has already
+    # been cancelled by jobstore.cancel_job; a job that finished in the meantime is kept.
+    if job['status'] == 'processing':
+        if not jobstore.finish_cancelled_job(job['id'], reason):
+            return
+    elif job['status'] != 'queued':
+        return
+    shutil.rmtree(job['job_dir'], ignore_errors=True)
+    try:
+        metrics.record_job('cancelled', time.time() - job['created_at'], json.loads(job['stats'] or '{}'))
+    except Exception as e:
+        print(f"Metrics Error: {e}")
+
+def supervise_job(job, process):
+    # Waits for the job process, stopping it when the job is cancelled or over budget
+    current_stage, stage_started = None, time.monotonic()
+    while True:
+        process.join(MONITOR_INTERVAL)
+        if not process.is_alive():
+            break
+        current = jobstore.get_job(job['id'])
+        if current is not None and current['status'] in jobstore.FINISHED_STATUSES:
+            # Done; the process is only recording metrics before it exits
+            continue
+        if current is not None and current['stage'] != current_stage:
+            current_stage, stage_started = current['stage'], time.monotonic()
+        reason = cancel_reason(current, stage_started)
+        if reason:
+            kill_job_process(process)
+            print(f"Job {job['id']} cancelled: {reason}")
+            if current is not None:
+                release_cancelled_job(current, reason)
+            return
+    if process.exitcode != 0:
+        # Killed from outside, e.g. by the kernel's OOM killer
+        current = jobstore.get_job(job['id'])
+        if current is not None and current['status'] == 'processing':
+            shutil.rmtree(job['job_dir'], ignore_errors=True)
+            jobstore.update_job(job['id'], status='error', disk_bytes=0,
+                                error=f"The conversion process stopped unexpectedly (exit code {process.exitcode})")
+
+def cancel_abandoned_jobs():
+    # E.g. the tab was closed: nobody polls or streams the job's status any more
+    for job in jobstore.abandoned_jobs(time.time() - ABANDONED_JOB_SECONDS):
+        reason = f"Cancelled: no client asked for this job for {ABANDONED_JOB_SECONDS} seconds"
+        if jobstore.cancel_job(job['id'], reason) == 'cancelled':
+            print(f"Job {job['id']} cancelled: {reason}")
+            release_cancelled_job(job, reason)
+
+def worker_loop():
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    running = None
+
+    def stop(signum, frame):
+        # The job process has its own process group and would outlive this worker
+        if running is not None and running.is_alive():
+            kill_job_process(running)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        job = jobstore.claim_job(worker_id)
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        running = multiprocessing.Process(target=job_process_main, args=(job,), name=f"job-{job['id']}")
+        running.start()
+        supervise_job(job, running)
+        running = None
+
+def main():
+    jobstore.init_db()
+    # Not daemonic: workers start their own process pools for image processing
+    processes = {}
+
+    def shutdown(signum, frame):
+        for process in processes.values():
+            process.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Also removes job directories left behind by the previous run
+    try:
+        storage.sweep()
+    except Exception as e:
+        print(f"Storage Error: {e}")
+    last_sweep = time.monotonic()
+    while True:
+        for slot in range(MAX_CONCURRENT_RENDERS):
+            process = processes.get(slot)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                print(f"Render worker {process.pid} exited with code {process.exitcode}, restarting")
+            process = multiprocessing.Process(target=worker_loop, name=f"render-worker-{slot}")
+            process.start()
+            processes[slot] = process
+        # Each task logs its errors (e.g. a locked database) and is retried next round,
+        # so one failure does not stop the supervisor for good
+        try:
+            jobstore.fail_stale_jobs(STALE_JOB_SECONDS)
+        except Exception as e:
+            print(f"Stale Jobs Error: {e}")
+        if ABANDONED_JOB_SECONDS:
+            try:
+                cancel_abandoned_jobs()
+            except Exception as e:
+                print(f"Cancel Error: {e}")
+        if time.monotonic() - last_sweep >= storage.STORAGE_SWEEP_SECONDS:
+            try:
+                storage.sweep()
+            except Exception as e:
+                print(f"Storage Error: {e}")
+            last_sweep = time.monotonic()
+        time.sleep(SUPERVISOR_INTERVAL)
+
+if __name__ == '__main__':
+    main()